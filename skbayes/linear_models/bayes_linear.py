@@ -3,10 +3,123 @@ from sklearn.base import RegressorMixin
 from sklearn.linear_model.base import LinearModel
 from sklearn.utils import check_X_y, check_array, as_float_array
 from sklearn.utils.validation import check_is_fitted
-from scipy.linalg import svd
+from scipy.linalg import eigh
+from scipy.linalg.lapack import get_lapack_funcs
+from scipy.linalg.blas import get_blas_funcs
+from numpy.linalg import LinAlgError
 import warnings
 
 
+# size of workspace for LAPACK gesdd, keyed by (dtype, shape) of design matrix
+_GESDD_LWORK = {}
+
+# approximate size (in bytes) of block of projections of test data on 
+# eigenvectors of posterior covariance in predict_dist (fits in L2 cache)
+_PREDICT_BLOCK_BYTES = 131072
+
+
+def _svd(X, overwrite_X = False):
+    '''
+    Thin SVD of design matrix computed by LAPACK gesdd (sgesdd or dgesdd 
+    depending on dtype of X). Optimal size of workspace is queried only once 
+    for each shape of design matrix, which saves time when the same model is 
+    refitted many times (cross-validation, bootstrap).
+    
+    Parameters
+    ----------
+    X: numpy array of size [n_samples,n_features]
+       Design matrix
+       
+    overwrite_X: bool, optional (DEFAULT = False)
+       If True, X can be destroyed (saves one copy of design matrix)
+       
+    Returns
+    -------
+    : list of three numpy arrays [u, d, vt]
+       Left singular vectors, singular values and right singular vectors
+    '''
+    # LAPACK works on Fortran-ordered arrays, for C-ordered X decompose X' 
+    # (Fortran-ordered view of the same memory), so that X can be overwritten 
+    # without making transposed copy
+    transposed = X.flags['C_CONTIGUOUS'] and not X.flags['F_CONTIGUOUS']
+    A = X.T if transposed else X
+    gesdd, gesdd_lwork = get_lapack_funcs(('gesdd','gesdd_lwork'), (A,))
+    key = (A.dtype.char, A.shape)
+    if key not in _GESDD_LWORK:
+        work, info = gesdd_lwork(A.shape[0], A.shape[1], compute_uv = 1,
+                                 full_matrices = 0)
+        # size is returned in working precision, round up so that it is not
+        # truncated in single precision
+        _GESDD_LWORK[key] = int(np.nextafter(work.real, np.inf))
+    u,d,vt,info = gesdd(A, compute_uv = 1, full_matrices = 0,
+                        lwork = _GESDD_LWORK[key], overwrite_a = int(overwrite_X))
+    if info > 0:
+        raise LinAlgError('SVD did not converge')
+    if info < 0:
+        raise ValueError('Illegal value in {0}-th argument of gesdd'.format(-info))
+    if transposed:
+        u, vt = vt.T, u.T
+    return [u,d,vt]
+    
+    
+def _spectral_decomposition(X, y, overwrite_X = False):
+    '''
+    Computes all quantities needed from SVD of design matrix: singular values,
+    right singular vectors, projection of y on left singular vectors and part 
+    of residual sum of squares that is orthogonal to column space of X.
+    For tall design matrices (n_samples > 4*n_features) eigendecomposition of
+    X'X is used instead of SVD, left singular vectors are never formed in that
+    case, since X'X = V*D^2*V' and U'y = D^-1*V'*X'y. Forming X'X squares 
+    condition number, so this is done only in double precision, single 
+    precision input is always decomposed by gesdd.
+    
+    Parameters
+    ----------
+    X: numpy array of size [n_samples,n_features]
+       Design matrix
+       
+    y: numpy array of size [n_samples]
+       Target values
+       
+    overwrite_X: bool, optional (DEFAULT = False)
+       If True, X can be destroyed
+       
+    Returns
+    -------
+    : list of four elements [d, vt, Uy, rss]
+       Singular values, right singular vectors, U'y and squared norm of 
+       y - U*U'y. Matrix vt is always Fortran-ordered, so V*x is computed by
+       BLAS gemv with trans=1 and neither V' nor V is ever copied (vt.T, 
+       used as eigenvectors of posterior covariance, is C-contiguous view).
+    '''
+    n_samples, n_features = X.shape
+    if n_samples > 4*n_features and X.dtype == np.float64:
+        w, v   = eigh(np.dot(X.T,X))
+        # singular values in decreasing order, as returned by SVD
+        w, vt  = w[::-1], np.asfortranarray(v[:,::-1].T)
+        # treat eigenvalues below numerical precision as zero
+        nonzero = w > w[0] * n_features * np.finfo(w.dtype).eps
+        d      = np.zeros(n_features, dtype = X.dtype)
+        d[nonzero] = np.sqrt(w[nonzero])
+        Uy     = np.dot(vt,np.dot(y,X))
+        Uy[nonzero] /= d[nonzero]
+        Uy[~nonzero] = 0
+        # y'y - U'y*U'y would lose precision by cancellation when residuals
+        # are small relative to y, so residuals of least squares solution 
+        # w = V*D^-1*U'y are computed directly (one pass over X)
+        w      = np.dot(vt[nonzero].T, Uy[nonzero] / d[nonzero])
+        error  = y - np.dot(X,w)
+        rss    = np.dot(error,error)
+    else:
+        u,d,vt = _svd(X, overwrite_X)
+        # copies (small) matrix only if X was decomposed in transposed form
+        vt     = np.asfortranarray(vt)
+        Uy     = np.dot(u.T,y)
+        error  = y - np.dot(u,Uy)
+        rss    = np.dot(error,error)
+    return [d,vt,Uy,rss]
+
+
 
 class BayesianLinearRegression(RegressorMixin,LinearModel):
     '''
@@ -35,8 +148,8 @@ class BayesianLinearRegression(RegressorMixin,LinearModel):
         # normalisation should be done in preprocessing!
         X_std = np.ones(X.shape[1], dtype = X.dtype)
         if self.fit_intercept:
-            X_mean = np.average(X,axis = 0)
-            y_mean = np.average(y,axis = 0)
+            X_mean = X.mean(axis = 0)
+            y_mean = y.mean(axis = 0)
             X     -= X_mean
             y      = y - y_mean
         else:
@@ -66,16 +179,54 @@ class BayesianLinearRegression(RegressorMixin,LinearModel):
             var_pred: numpy array of size (n_test_samples,)
                       Variance of predictive distribution        
         '''
-        # Note check_array and check_is_fitted are done within self._decision_function(X)
-        mu_pred     = self._decision_function(X)
+        # validate X once, both mean and variance are computed from it;
+        # eigvals_ and eigvecs_ are stored in fit, so no work that depends 
+        # only on alpha_ and beta_ is repeated here
+        check_is_fitted(self, 'coef_')
+        X           = check_array(X)
+        mu_pred     = np.dot(X,self.coef_) + self.intercept_
         data_noise  = 1./self.beta_
-        model_noise = np.sum(np.dot(X,self.eigvecs_)**2 * self.eigvals_,1)
-        var_pred    =  data_noise + model_noise
+        # process test data in blocks of rows, so that projections on 
+        # eigenvectors are not materialised for whole test set at once
+        n_block     = max(1, _PREDICT_BLOCK_BYTES // (X.itemsize * 
+                                                      self.eigvecs_.shape[1]))
+        var_pred    = np.empty(X.shape[0], dtype = mu_pred.dtype)
+        for start in range(0, X.shape[0], n_block):
+            proj    = np.dot(X[start:start + n_block],self.eigvecs_)
+            proj   *= proj
+            var_pred[start:start + n_block] = np.dot(proj, self.eigvals_)
+        var_pred   += data_noise
         return [mu_pred,var_pred]
     
         
         
 
+def _fp_update(alpha, beta, sqdMu, sqdErr, dsq, shrink, n_samples, n_features):
+    '''
+    Fixed-point Gull-MacKay update of precision parameters
+    (shrink = 1/(D^2 + alpha/beta), so beta*D^2/(beta*D^2 + alpha) = D^2*shrink)
+    '''
+    gamma      =  np.dot(dsq, shrink)
+    # use updated mu and gamma parameters to update alpha and beta
+    # !!! made computation numerically stable for perfect fit case
+    alpha      =   gamma  / (sqdMu + np.finfo(np.float32).eps )
+    beta       =  ( n_samples - gamma ) / (sqdErr + np.finfo(np.float32).eps )
+    return alpha, beta
+    
+    
+def _em_update(alpha, beta, sqdMu, sqdErr, dsq, shrink, n_samples, n_features):
+    '''
+    M-step, updates precision parameters alpha and beta to maximize ML TYPE II
+    (shrink = 1/(D^2 + alpha/beta), so eigenvalues of covariance are shrink/beta;
+    eigenvalues of covariance that are not spanned by X are 1/alpha)
+    '''
+    trace_S    = np.sum(shrink) / beta + (n_features - dsq.shape[0]) / alpha
+    alpha      = n_features / ( sqdMu + trace_S )
+    beta       = n_samples / ( sqdErr + np.dot(dsq, shrink) / beta )
+    return alpha, beta
+        
+        
+
 class EBLinearRegression(BayesianLinearRegression):
     '''
     Bayesian Regression with type II maximum likelihood (Empirical Bayes)
@@ -92,6 +243,7 @@ class EBLinearRegression(BayesianLinearRegression):
        Method for optimization , either Expectation Maximization or 
        Fixed Point Gull-MacKay {'em','fp'}. Fixed point iterations are
        faster, but can be numerically unstable (especially in case of near perfect fit).
+       EM updates are accelerated with SQUAREM extrapolation.
        
     fit_intercept: bool, optional (DEFAULT = True)
        If True includes bias term in model
@@ -106,7 +258,9 @@ class EBLinearRegression(BayesianLinearRegression):
        very broad distribution )
        
     copy_X : boolean, optional (DEFAULT = True)
-        If True, X will be copied, otherwise will be 
+        If True, X will be copied, otherwise it will be overwritten (input 
+        array is centered and may then be used as workspace of SVD, so after
+        fit its content is unspecified)
         
     verbose: bool, optional (Default = False)
        If True at each iteration progress report is printed out
@@ -141,7 +295,6 @@ class EBLinearRegression(BayesianLinearRegression):
         self.optimizer     =  optimizer 
         self.alpha         =  alpha 
         self.perfect_fit   =  False
-        self.scores_       =  [np.NINF]
         self.perfect_fit_tol = perfect_fit_tol
 
             
@@ -164,39 +317,47 @@ class EBLinearRegression(BayesianLinearRegression):
     
         '''
         # preprocess data
-        X, y = check_X_y(X, y, dtype=np.float64, y_numeric=True)
+        X, y = check_X_y(X, y, dtype=[np.float64, np.float32], y_numeric=True)
+        y    = y.astype(X.dtype, copy = False)
         n_samples, n_features = X.shape
         X, y, X_mean, y_mean, X_std = self._center_data(X, y)
-        #  precision of noise & and coefficients
+        #  precision of noise & and coefficients (deterministic initialisation,
+        #  noise precision starts from moment estimate 1 / var(y))
         alpha   =  self.alpha
         var_y  = np.var(y)
         # check that variance is non zero !!!
         if var_y == 0 :
             beta = 1e-2
         else:
-            beta = 1. / np.var(y)
+            beta = 1. / var_y
 
         # to speed all further computations save svd decomposition and reuse it later
-        u,d,vt   = svd(X, full_matrices = False)
-        Uy      = np.dot(u.T,y)
+        # (part of RSS that is orthogonal to column space of X does not 
+        # depend on precision parameters)
+        # (centered X is not used after decomposition, so it is overwritten)
+        d,vt,Uy,rss = _spectral_decomposition(X, y, overwrite_X = True)
         dsq     = d**2
+        # D*U'y does not depend on precision parameters
+        dUy     = d*Uy
+        # BLAS routines are bound once, calling them directly avoids numpy
+        # dispatch overhead, which dominates for small problems
+        gemv, dot = get_blas_funcs(('gemv','dot'), (X,))
+        # choose update of precision parameters once; EM converges linearly,
+        # so EM updates are accelerated by SQUAREM extrapolation 
+        # (Varadhan & Roland, 2008)
+        if self.optimizer == "fp":
+            update, accelerate = _fp_update, False
+        else:
+            update, accelerate = _em_update, True
         mu      = 0
+        self.perfect_fit = False
     
         for i in range(self.n_iter):
             
             # find mean for posterior of w ( for EM this is E-step)
             mu_old  =  mu
-            if n_samples > n_features:
-                 mu =  vt.T *  d/(dsq+alpha/beta) 
-            else:
-                 # clever use of SVD here , faster for large n_features
-                 mu =  u * 1./(dsq + alpha/beta)
-                 mu =  np.dot(X.T,mu)
-            mu =  np.dot(mu,Uy)
-
-            # precompute errors, since both methods use it in estimation
-            error   = y - np.dot(X,mu)
-            sqdErr  = np.sum(error**2)
+            mu, sqdMu, sqdErr, shrink = self._posterior_mean(alpha, beta, dsq, Uy,
+                                                             dUy, vt, rss, gemv, dot)
             
             if sqdErr / n_samples < self.perfect_fit_tol:
                 self.perfect_fit = True
@@ -204,17 +365,13 @@ class EBLinearRegression(BayesianLinearRegression):
                                 'for predictive distribution are computed using only RSS'))
                 break
             
-            if self.optimizer == "fp":           
-                gamma      =  np.sum(beta*dsq/(beta*dsq + alpha))
-                # use updated mu and gamma parameters to update alpha and beta
-                # !!! made computation numerically stable for perfect fit case
-                alpha      =   gamma  / (np.sum(mu**2) + np.finfo(np.float32).eps )
-                beta       =  ( n_samples - gamma ) / (sqdErr + np.finfo(np.float32).eps )
-            else:             
-                # M-step, update parameters alpha and beta to maximize ML TYPE II
-                eigvals    = 1. / (beta * dsq + alpha)
-                alpha      = n_features / ( np.sum(mu**2) + np.sum(1/eigvals) )
-                beta       = n_samples / ( sqdErr + np.sum(dsq/eigvals) )
+            if accelerate:
+                alpha, beta = self._squarem(update, alpha, beta, sqdMu, sqdErr,
+                                            shrink, n_samples, dsq, Uy, dUy, vt,
+                                            rss, gemv, dot)
+            else:
+                alpha, beta = update(alpha, beta, sqdMu, sqdErr, dsq, shrink,
+                                     n_samples, n_features)
 
             # if converged or exceeded maximum number of iterations => terminate
             converged = self._check_convergence(mu_old,mu)
@@ -225,13 +382,94 @@ class EBLinearRegression(BayesianLinearRegression):
             if converged or i==self.n_iter -1:
                 break
         eigvals       = 1./(beta * dsq + alpha)
-        self.coef_    = beta*np.dot(vt.T*d*eigvals ,Uy)
+        # in case of perfect fit loop terminates before update of alpha and 
+        # beta, so mean computed in last iteration can be reused
+        if not self.perfect_fit:
+            mu        = gemv(beta, vt, dUy*eigvals, trans = 1)
+        self.coef_    = mu
         self._set_intercept(X_mean,y_mean,X_std)
         self.beta_    = beta
         self.alpha_   = alpha
         self.eigvals_ = eigvals
         self.eigvecs_ = vt.T
         return self
+        
+        
+    def _posterior_mean(self, alpha, beta, dsq, Uy, dUy, vt, rss, gemv, dot):
+        '''
+        Calculates mean of posterior distribution of weights, its squared norm,
+        residual sum of squares and vector 1/(D^2 + alpha/beta) (shared with 
+        updates of precision parameters)
+        '''
+        # thin SVD gives X'U = V*D, so posterior mean needs only k-length
+        # vector ops and one product with right singular vectors
+        # (independent of n_samples and valid for n_samples <= n_features)
+        lambd   = alpha/beta
+        shrink  = dsq + lambd
+        np.reciprocal(shrink, out = shrink)
+        mu      = gemv(1., vt, dUy*shrink, trans = 1)
+        # X*mu = U*D*(D*U'y/(D^2+alpha/beta)), so in the column space of X 
+        # residuals are (alpha/beta)*U'y/(D^2+alpha/beta), remaining part
+        # of RSS is precomputed
+        error   = Uy*shrink
+        sqdErr  = rss + lambd**2 * dot(error,error)
+        return mu, dot(mu,mu), sqdErr, shrink
+        
+        
+    def _log_evidence(self, alpha, beta, sqdMu, sqdErr, dsq, n_samples):
+        '''
+        Calculates log of marginal likelihood (up to additive constant)
+        '''
+        # log|A| - n_features*log(alpha) = sum(log(1 + beta/alpha*d**2)), since 
+        # eigenvalues of precision matrix A not spanned by X are alpha; computed 
+        # in place in a single temporary array 
+        logdet  = (beta/alpha)*dsq
+        np.log1p(logdet, out = logdet)
+        return 0.5*( n_samples*np.log(beta) - beta*sqdErr - alpha*sqdMu - 
+                     np.sum(logdet) )
+        
+        
+    def _squarem(self, update, alpha, beta, sqdMu, sqdErr, shrink, n_samples, dsq,
+                 Uy, dUy, vt, rss, gemv, dot):
+        '''
+        Squared extrapolation of two successive updates of precision 
+        parameters (update is _em_update or _fp_update). Parameters are 
+        extrapolated in log space (to keep them positive), step length is 
+        shrunk towards plain double update if log evidence decreases.
+        '''
+        n_features  = vt.shape[1]
+        log_ev      = self._log_evidence(alpha, beta, sqdMu, sqdErr, dsq, n_samples)
+        theta0      = np.log([alpha, beta])
+        alpha1, beta1 = update(alpha, beta, sqdMu, sqdErr, dsq, shrink, n_samples,
+                               n_features)
+        mu, sqdMu, sqdErr, shrink = self._posterior_mean(alpha1, beta1, dsq, Uy,
+                                                         dUy, vt, rss, gemv, dot)
+        # near perfect fit is handled in main loop, so make plain update
+        if sqdErr / n_samples < self.perfect_fit_tol:
+            return alpha1, beta1
+        alpha, beta = update(alpha1, beta1, sqdMu, sqdErr, dsq, shrink, n_samples,
+                             n_features)
+        theta1      = np.log([alpha1, beta1])
+        r           = theta1 - theta0
+        v           = np.log([alpha, beta]) - 2*theta1 + theta0
+        norm_v      = np.sqrt(np.sum(v**2))
+        if norm_v == 0:
+            return alpha, beta
+        step        = min(-np.sqrt(np.sum(r**2)) / norm_v, -1.)
+        while True:
+            alpha, beta = np.exp(theta0 - 2*step*r + step**2*v)
+            mu, sqdMu, sqdErr, shrink = self._posterior_mean(alpha, beta, dsq, Uy,
+                                                             dUy, vt, rss, gemv,
+                                                             dot)
+            if sqdErr / n_samples < self.perfect_fit_tol:
+                return alpha1, beta1
+            if step == -1 or self._log_evidence(alpha, beta, sqdMu, sqdErr, dsq,
+                                                n_samples) >= log_ev:
+                break
+            step = (step - 1) / 2. if step < -2 else -1.
+        # stabilising update
+        return update(alpha, beta, sqdMu, sqdErr, dsq, shrink, n_samples,
+                      n_features)
             
             
 # ==============================  VBLR  =========================================
@@ -285,6 +523,11 @@ class VBLinearRegression(BayesianLinearRegression):
     d: float, optional (Default = 1e-4)
        Rate parameter of  Gamma prior for precision of noise
        
+    copy_X : boolean, optional (DEFAULT = True)
+        If True, X will be copied, otherwise it will be overwritten (input 
+        array is centered and may then be used as workspace of SVD, so after
+        fit its content is unspecified)
+       
     verbose: bool, optional (Default = False)
        If True at each iteration progress report is printed out
        
@@ -337,13 +580,14 @@ class VBLinearRegression(BayesianLinearRegression):
           self
         '''
         # preprocess data
-        X, y = check_X_y(X, y, dtype=np.float64, y_numeric=True)
+        X, y = check_X_y(X, y, dtype=[np.float64, np.float32], y_numeric=True)
+        y    = y.astype(X.dtype, copy = False)
         n_samples, n_features = X.shape
         X, y, X_mean, y_mean, X_std = self._center_data(X, y)        
         # SVD decomposition, done once , reused at each iteration
-        u,D,vt = svd(X, full_matrices = False)
+        # (part of RSS orthogonal to column space of X is constant over iterations)
+        D,vt,UY,rss = _spectral_decomposition(X, y, overwrite_X = True)
         dsq    = D**2
-        UY     = np.dot(u.T,y)
         
         # some parameters of Gamma distribution have closed form solution
         a      = self.a + 0.5 * n_features
@@ -358,14 +602,15 @@ class VBLinearRegression(BayesianLinearRegression):
             # update parameters of distribution Q(weights)
             e_beta       = gamma_mean(c,d)
             e_alpha      = gamma_mean(a,b)
-            mu_old       = np.copy(mu)
-            mu,eigvals   = self._posterior_weights(e_beta,e_alpha,UY,dsq,u,vt,D,X)
+            mu_old       = mu
+            mu,eigvals   = self._posterior_weights(e_beta,e_alpha,UY,dsq,vt,D)
             
             # update parameters of distribution Q(precision of weights) 
             b            = self.b + 0.5*( np.sum(mu**2) + np.sum(eigvals))
             
             # update parameters of distribution Q(precision of likelihood)
-            sqderr       = np.sum((y - np.dot(X,mu))**2)
+            # (residuals in column space of X are e_alpha*U'y*eigvals)
+            sqderr       = rss + e_alpha**2 * np.sum((UY*eigvals)**2)
             xsx          = np.sum(dsq*eigvals)
             d            = self.d + 0.5*(sqderr + xsx)
  
@@ -384,13 +629,13 @@ class VBLinearRegression(BayesianLinearRegression):
         self.beta_   = gamma_mean(c,d)
         self.alpha_  = gamma_mean(a,b)
         self.coef_, self.eigvals_ = self._posterior_weights(self.beta_, self.alpha_, UY,
-                                                            dsq, u, vt, D, X)
+                                                            dsq, vt, D)
         self._set_intercept(X_mean,y_mean,X_std)
         self.eigvecs_ = vt.T
         return self
         
 
-    def _posterior_weights(self, e_beta, e_alpha, UY, dsq, u, vt, d, X):
+    def _posterior_weights(self, e_beta, e_alpha, UY, dsq, vt, d):
         '''
         Calculates parameters of approximate posterior distribution 
         of weights
@@ -399,12 +644,6 @@ class VBLinearRegression(BayesianLinearRegression):
         sigma = 1./ (e_beta*dsq + e_alpha)
         
         # mean of approximate posterior distribution
-        n_samples, n_features = X.shape
-        if n_samples > n_features:
-             mu =  vt.T *  d/(dsq + e_alpha/e_beta)# + np.finfo(np.float64).eps) 
-        else:
-             mu =  u * 1./(dsq + e_alpha/e_beta)# + np.finfo(np.float64).eps)
-             mu =  np.dot(X.T,mu)
-        mu =  np.dot(mu,UY)
+        mu =  np.dot(vt.T, d*UY/(dsq + e_alpha/e_beta))
         return mu,sigma
         
@@ -5,6 +5,7 @@ import numpy as np
 from sklearn.utils.estimator_checks import check_estimator
 from skbayes.linear_models import (EBLinearRegression,VBLinearRegression,
                                    EBLogisticRegression, VBLogisticRegression)
+from skbayes.linear_models.bayes_linear import _spectral_decomposition, _svd
 from skbayes.rvm_ard_models import ( VBRegressionARD, VBClassificationARD,
                                      ClassificationARD, RegressionARD, RVR, RVC)
                                      
@@ -68,7 +69,161 @@ class TestSupervised(unittest.TestCase):
             # test that 'predict' and 'predict_dist' return the same point estimate
             # ( Note! in RVR & VRVR these are calculated differently)
             np.testing.assert_allclose( model.predict(X), yh)
+            
+            
+    def test_linear_posterior_dense(self):
+        '''
+        Tests that posterior distribution of weights and predictive variance
+        in Bayesian linear regression (computed with broadcasting of 
+        eigenvalues, without dense diagonal matrices) coincide with explicit
+        dense computation  S = V * diag(eigvals) * V'
+        (for SVD of design matrix and for eigendecomposition of X'X, which is
+        used for tall design matrices, in double and single precision), and
+        that estimated precision parameters are stationary point of evidence
+        (EB) or of variational lower bound (VB)
+        '''
+        rng = np.random.RandomState(0)
+        X_tall = rng.randn(200,8)
+        # exactly collinear column, X'X is singular
+        X_tall[:,7] = X_tall[:,0] - X_tall[:,1]
+        
+        for X in [rng.randn(32,8), X_tall]:
+            n   = X.shape[0]
+            y   = np.dot(X,rng.randn(8)) + rng.randn(n)
+            Xc  = X - np.mean(X,0)
+            yc  = y - np.mean(y)
+            
+            # single precision input is fitted in single precision
+            for dtype, rtol, atol in [(np.float64, 1e-6, 1e-9),
+                                      (np.float32, 1e-4, 1e-5)]:
+                
+                def assert_close(actual, desired):
+                    np.testing.assert_allclose(actual, desired, rtol = rtol, 
+                                               atol = atol*np.max(abs(desired)))
+        
+                for model in [EBLinearRegression(optimizer = 'fp'),
+                              EBLinearRegression(optimizer = 'em'),
+                              VBLinearRegression()]:
+                    model.fit(X.astype(dtype), y.astype(dtype))
+                    alpha, beta = float(model.alpha_), float(model.beta_)
+                    S = np.dot(np.dot(model.eigvecs_, np.diag(model.eigvals_)),
+                               model.eigvecs_.T)
+            
+                    # covariance is inverse of beta*X'X + alpha*I
+                    S_dense = np.linalg.inv( beta*np.dot(Xc.T,Xc) + 
+                                             alpha*np.diag(np.ones(8)) )
+                    assert_close(S, S_dense)
+            
+                    # mean of posterior
+                    mu_dense = beta*np.dot(S_dense,np.dot(Xc.T,yc))
+                    assert_close(model.coef_, mu_dense)
+            
+                    # variance of predictive distribution
+                    _, var = model.predict_dist(X.astype(dtype))
+                    var_dense = 1./beta + np.sum(np.dot(X,S_dense)*X,1)
+                    assert_close(var, var_dense)
+                    
+                    # updates of precision parameters at convergence
+                    sqd_err = np.sum((yc - np.dot(Xc,mu_dense))**2)
+                    if isinstance(model, EBLinearRegression):
+                        gamma     = 8 - alpha*np.trace(S_dense)
+                        alpha_new = gamma / np.dot(mu_dense,mu_dense)
+                        beta_new  = (n - gamma) / sqd_err
+                    else:
+                        alpha_new = (model.a + 4) / (model.b + 0.5*( 
+                                     np.dot(mu_dense,mu_dense) + np.trace(S_dense)))
+                        beta_new  = (model.c + 0.5*n) / (model.d + 0.5*( sqd_err +
+                                     np.sum(np.dot(Xc,S_dense)*Xc)))
+                    np.testing.assert_allclose([alpha_new, beta_new], [alpha, beta],
+                                               rtol = 1e-3)
+                
+                
+    def test_spectral_decomposition_tall(self):
+        '''
+        Tests that eigendecomposition of X'X (used for tall design matrices)
+        gives the same singular values, projections of y on left singular 
+        vectors and residual sum of squares as SVD of design matrix
+        '''
+        rng = np.random.RandomState(0)
+        X   = rng.randn(200,8)
+        # exactly collinear column, one singular value is zero
+        X[:,7] = X[:,0] - X[:,1]
+        y   = np.dot(X,rng.randn(8)) + rng.randn(200)
+        X   = X - np.mean(X,0)
+        y   = y - np.mean(y)
+        
+        d, vt, Uy, rss  = _spectral_decomposition(X.copy(), y)
+        u, d_svd, vt_svd = _svd(X.copy())
+        Uy_svd  = np.dot(u.T,y)
+        rss_svd = np.sum((y - np.dot(u,Uy_svd))**2)
+        
+        np.testing.assert_allclose(d, d_svd, atol = 1e-10*d_svd[0])
+        self.assertEqual(d[-1], 0)
+        np.testing.assert_allclose(abs(Uy[:-1]), abs(Uy_svd[:-1]), rtol = 1e-8)
+        # projection of y on left singular vector with zero singular value
+        # is part of residuals when X'X is decomposed
+        self.assertEqual(Uy[-1], 0)
+        np.testing.assert_allclose(rss, rss_svd + Uy_svd[-1]**2, rtol = 1e-8)
+
+        # large signal, small noise: residual sum of squares is tiny compared
+        # to y'y, so it should not be obtained by subtraction
+        X   = rng.randn(400,8)
+        y   = 1e4*np.dot(X,rng.randn(8)) + 1e-3*rng.randn(400)
+        Xc  = X - np.mean(X,0)
+        yc  = y - np.mean(y)
+        _, _, _, rss = _spectral_decomposition(Xc.copy(), yc)
+        u, _, _ = _svd(Xc.copy())
+        np.testing.assert_allclose(rss, np.sum((yc - np.dot(u,np.dot(u.T,yc)))**2),
+                                   rtol = 1e-6)
+        # zero columns do not change fixed-point solution, but make design
+        # matrix wide enough to be decomposed by gesdd
+        X_wide = np.hstack([X, np.zeros((400,92))])
+        tall = EBLinearRegression().fit(X,y)
+        wide = EBLinearRegression().fit(X_wide,y)
+        np.testing.assert_allclose(tall.beta_, wide.beta_, rtol = 1e-6)
+
+
+    def test_linear_em_fp(self):
+        '''
+        Tests that EM and fixed-point updates of precision parameters in
+        Empirical Bayes linear regression converge to the same maximum of
+        evidence
+        '''
+        rng = np.random.RandomState(0)
+        for n_samples in [32,200]:
+            X   = rng.randn(n_samples,8)
+            y   = np.dot(X,rng.randn(8)) + rng.randn(n_samples)
+            fp  = EBLinearRegression(optimizer = 'fp').fit(X,y)
+            em  = EBLinearRegression(optimizer = 'em').fit(X,y)
+            np.testing.assert_allclose([em.alpha_, em.beta_],
+                                       [fp.alpha_, fp.beta_], rtol = 1e-4)
+            np.testing.assert_allclose(em.coef_, fp.coef_, rtol = 1e-4)
+
+
+    def test_linear_float32(self):
+        '''
+        Tests that Bayesian linear regression fitted on single precision data
+        agrees with fit on double precision data (tall and moderately
+        ill-conditioned design matrix, condition number 1e3)
+        '''
+        rng  = np.random.RandomState(0)
+        u,_  = np.linalg.qr(rng.randn(2000,20))
+        v,_  = np.linalg.qr(rng.randn(20,20))
+        X    = np.dot(u*np.logspace(0,-3,20), v.T)
+        y    = np.dot(X,rng.randn(20)) + 1e-2*rng.randn(2000)
+
+        for model in [EBLinearRegression(optimizer = 'fp'),
+                      EBLinearRegression(optimizer = 'em'),
+                      VBLinearRegression()]:
+            model_64 = model.fit(X,y)
+            coef_64, alpha_64, beta_64 = model_64.coef_, model_64.alpha_, model_64.beta_
+            model_32 = model.fit(X.astype(np.float32), y.astype(np.float32))
+            self.assertEqual(model_32.coef_.dtype, np.float32)
+            np.testing.assert_allclose(model_32.coef_, coef_64,
+                                       rtol = 1e-4, atol = 1e-4*np.max(abs(coef_64)))
+            np.testing.assert_allclose([model_32.alpha_, model_32.beta_],
+                                       [alpha_64, beta_64], rtol = 1e-4)
+
 
-    
 if __name__ == '__main__':
     unittest.main()